@@ -26,7 +26,8 @@
 # STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
 # OF THE POSSIBILITY OF SUCH DAMAGE.
-import rospy, hpp.corbaserver
+import rospy, hpp.corbaserver, CORBA
+from CORBA import UserException
 from .client import HppClient
 from dynamic_graph_bridge_msgs.msg import Vector
 from geometry_msgs.msg import TransformStamped
@@ -34,10 +35,29 @@ from sensor_msgs.msg import JointState
 from tf import TransformBroadcaster
 from std_msgs.msg import Empty, UInt32
 from std_srvs.srv import SetBool, SetBoolRequest
-from math import cos, sin
-from threading import Lock
-import traceback
+from threading import RLock
+from collections import OrderedDict
+import numpy as np
+from numpy.linalg import norm
+import traceback, logging
 import ros_tools
+try:
+    from sys import intern
+except ImportError:
+    pass # Python 2: intern is a builtin
+
+# Logger used by rospy.logdebug, rospy.loginfo...
+_rosout_logger = logging.getLogger("rosout")
+
+## Z component of the Z axis rotated by quaternion (x, y, z, w).
+## This is the third coordinate of R * [0, 0, 1], without building a Quaternion.
+def _rotatedZAxisZ (x, y, z, w):
+    return (w*w + z*z - x*x - y*y) / (x*x + y*y + z*z + w*w)
+
+## Inverse of quaternion (x, y, z, w), i.e. its conjugate divided by its squared norm.
+def _quaternionInverse (x, y, z, w):
+    n = x*x + y*y + z*z + w*w
+    return (-x/n, -y/n, -z/n, w/n)
 
 ### \brief Estimation based on HPP constraint solver.
 ##
@@ -94,15 +114,15 @@ class Estimation(HppClient):
     def __init__ (self, continuous_estimation = False,
              joint_states_topic="/joint_states",
              visual_tags_enabled=True):
+        # Reentrant because callbacks holding it may reconnect to HPP, see _connect.
+        # It must exist before HppClient.__init__ connects.
+        self.mutex = RLock()
+        # The robot cache is initialized by _connect.
         super(Estimation, self).__init__ (context = "estimation")
 
-        self.locked_joints = []
-
         self.tf_pub = TransformBroadcaster()
         self.tf_root = "world"
 
-        self.mutex = Lock()
-
         self.robot_name = rospy.get_param("~robot_name", "")
 
         self.last_stamp_is_ready = False
@@ -112,102 +132,156 @@ class Estimation(HppClient):
         self.current_stamp = rospy.Time.now()
         self.current_visual_tag_constraints = list()
         self.visual_tags_enabled = visual_tags_enabled
+        # Priorities passed to addNumericalConstraints, kept between estimations.
+        self._default_priorities = list()
+        self._visual_tag_priorities = list()
 
         self.continuous_estimation (SetBoolRequest(continuous_estimation))
         self.estimation_rate = 50 # Hz
 
         self.subscribers = ros_tools.createSubscribers (self, "/agimus", self.subscribersDict)
         self.publishers  = ros_tools.createPublishers ("/agimus", self.publishersDict)
+        self._publish_semantic = self.publishers["estimation"]["semantic"].publish
+        self._publish_state_id = self.publishers["estimation"]["state_id"].publish
         self.services    = ros_tools.createServices (self, "/agimus", self.servicesDict)
         self.joint_state_subs = rospy.Subscriber (joint_states_topic, JointState, self.get_joint_state)
 
+    def _connect (self):
+        # tryConnect and setHppUrl reach this without holding the mutex.
+        with self.mutex:
+            super(Estimation, self)._connect()
+            # The robot may have changed if the server was restarted.
+            self._reset_robot_cache()
+
+    ## Forget the information about the robot model gathered from HPP.
+    def _reset_robot_cache (self):
+        self.locked_joints = []
+        # JointState joint name -> joint information, see _get_joint_meta
+        self._joint_meta = dict()
+        # See _make_tf_publish_plan
+        self._tf_publish_plan = None
+        self._tf_publish_links = None
+        self._has_links_position = False
+
     def continuous_estimation(self, msg):
         self.run_continuous_estimation = msg.data
         rospy.loginfo ("Run continuous estimation: {0}".format(self.run_continuous_estimation))
         return True, "ok"
 
+    ## Run the continuous estimation at Estimation.estimation_rate until ROS shuts down.
     def spin (self):
-        rate = rospy.Rate(self.estimation_rate)
-        while not rospy.is_shutdown():
-            if self.run_continuous_estimation and self.last_stamp_is_ready:
-                rospy.logdebug("Runnning estimation...")
-                self.estimation()
-            else:
-                rospy.logdebug ("run continuous estimation."
-                        +"run_continuous_estimation={0}, last_stamp_is_ready={1}"
-                        .format(self.run_continuous_estimation, self.last_stamp_is_ready))
-            rate.sleep()
+        self.estimation_timer = rospy.Timer (rospy.Duration(1. / self.estimation_rate), self._estimation_tick)
+        rospy.spin()
+
+    def _estimation_tick (self, event):
+        if not self.run_continuous_estimation or not self.last_stamp_is_ready:
+            rospy.logdebug ("run continuous estimation."
+                    +"run_continuous_estimation={0}, last_stamp_is_ready={1}"
+                    .format(self.run_continuous_estimation, self.last_stamp_is_ready))
+            return
+        rospy.logdebug("Runnning estimation...")
+        self.estimation()
 
     def estimation (self, msg=None):
-        self.mutex.acquire()
-
-        try:
-            hpp = self.hpp()
-            q_current = hpp.robot.getCurrentConfig()
-
-            self._initialize_constraints (q_current)
-
-            # The optimization expects a configuration which already satisfies the constraints
-            projOk, q_projected, error = hpp.problem.applyConstraints (q_current)
-
-            if projOk:
-                optOk, q_estimated, error = hpp.problem.optimize (q_projected)
-                if not optOk:
-                    from numpy.linalg import norm
-                    errNorm = norm(error)
-                    if errNorm > 1e-2:
-                      rospy.logwarn_throttle (1 ,"Optimisation failed ? error norm: {0}".format(errNorm))
-                      rospy.logdebug_throttle (1 ,"estimated == projected: {0}".format(q_projected==q_estimated))
-                    else:
-                      rospy.loginfo_throttle (1 ,"Optimisation failed ? error norm: {0}".format(errNorm))
-                    rospy.logdebug_throttle (1 ,"Error {0}".format(error))
-
-                valid, msg = hpp.robot.isConfigValid (q_estimated)
-                if not valid:
-                    rospy.logwarn_throttle (1, "Estimation in collision: {0}".format(msg))
-
-                self.publishers["estimation"]["semantic"].publish (q_estimated)
-
-                self.publish_state (hpp)
-            else:
-                hpp.robot.setCurrentConfig (q_current)
-                q_estimated = q_current
-                rospy.logwarn_throttle (1, "Could not apply the constraints {0}".format(error))
-        except Exception as e:
-            rospy.logerr_throttle (1, str(e))
-            rospy.logerr_throttle (1, traceback.format_exc())
-        finally:
-            self.last_stamp_is_ready = False
-            self.mutex.release()
+        with self.mutex:
+            try:
+                hpp = self.hpp()
+                robot = hpp.robot
+                q_current = robot.getCurrentConfig()
+
+                self._initialize_constraints (hpp, q_current)
+
+                # The optimization expects a configuration which already satisfies the constraints
+                projOk, q_projected, error = hpp.problem.applyConstraints (q_current)
+
+                if projOk:
+                    optOk, q_estimated, error = hpp.problem.optimize (q_projected)
+                    if not optOk:
+                        errNorm = norm(error)
+                        debug = _rosout_logger.isEnabledFor(logging.DEBUG)
+                        if errNorm > 1e-2:
+                          rospy.logwarn_throttle (1 ,"Optimisation failed ? error norm: {0}".format(errNorm))
+                          if debug:
+                            rospy.logdebug_throttle (1 ,"estimated == projected: {0}".format(np.array_equal(q_projected, q_estimated)))
+                        else:
+                          rospy.loginfo_throttle (1 ,"Optimisation failed ? error norm: {0}".format(errNorm))
+                        if debug:
+                          rospy.logdebug_throttle (1 ,"Error {0}".format(error))
+
+                    valid, msg = robot.isConfigValid (q_estimated)
+                    if not valid:
+                        rospy.logwarn_throttle (1, "Estimation in collision: {0}".format(msg))
+
+                    self._publish_semantic (q_estimated)
+
+                    self.publish_state (hpp)
+                else:
+                    robot.setCurrentConfig (q_current)
+                    q_estimated = q_current
+                    rospy.logwarn_throttle (1, "Could not apply the constraints {0}".format(error))
+            except Exception as e:
+                rospy.logerr_throttle (1, str(e))
+                rospy.logerr_throttle (1, traceback.format_exc())
+            finally:
+                self.last_stamp_is_ready = False
 
     ## Publish tranforms to tf
     # By default, only the child joints of universe are published.
     def publish_state (self, hpp):
-        robot_name = hpp.robot.getRobotName()
-        if not hasattr(self, 'universe_child_joint_names'):
-            self.universe_child_joint_names = [ jn for jn in hpp.robot.getJointNames() if "universe" == hpp.robot.getParentJointName(jn) ]
-            rospy.loginfo("Will publish joints {0}".format(self.universe_child_joint_names))
-        for jn in self.universe_child_joint_names:
-            links = hpp.robot.getLinkNames(jn)
-            for l in links:
-                T = hpp.robot.getLinkPosition (l)
-                if l.startswith(robot_name):
-                    name = l[len(robot_name)+1:]
-                else:
-                    name = l
-                self.tf_pub.sendTransform (T[0:3], T[3:7], self.last_stamp, name, self.tf_root)
-        # Publish the robot link as estimated.
-        robot_joints = filter(lambda x: x.startswith(robot_name), hpp.robot.getAllJointNames())
-        for jn in robot_joints:
-            links = hpp.robot.getLinkNames(jn)
-            for name in links:
-                T = hpp.robot.getLinkPosition (name)
-                self.tf_pub.sendTransform (T[0:3], T[3:7], self.last_stamp, name, self.tf_root)
-
-    def _initialize_constraints (self, q_current):
-        from CORBA import UserException
-        hpp = self.hpp()
+        robot = hpp.robot
+        if self._tf_publish_plan is None:
+            self._tf_publish_plan = self._make_tf_publish_plan (hpp)
+            self._tf_publish_links = [ link for link, _ in self._tf_publish_plan ]
+            # Recent versions of hpp-corbaserver can compute the positions of
+            # several links in one request.
+            self._has_links_position = hasattr(robot, "getLinksPosition")
+        Ts = None
+        if self._has_links_position:
+            try:
+                Ts = robot.getLinksPosition (robot.getCurrentConfig(), self._tf_publish_links)
+            except (CORBA.BAD_OPERATION, UserException) as e:
+                # The stubs know getLinksPosition but the server does not.
+                rospy.logwarn ("Cannot use getLinksPosition, falling back to getLinkPosition: {0}".format(e))
+                self._has_links_position = False
+        if Ts is None:
+            Ts = [ robot.getLinkPosition (link) for link in self._tf_publish_links ]
+        sendTransform = self.tf_pub.sendTransform
+        stamp = self.last_stamp
+        for (link, tf_names), T in zip(self._tf_publish_plan, Ts):
+            for name in tf_names:
+                sendTransform (T[0:3], T[3:7], stamp, name, self.tf_root)
+
+    ## Compute the list of links published by publish_state.
+    ## \return a list of pairs (link name, tuple of tf frame names). Each link
+    ##         appears once so that its position is queried once per call.
+    def _make_tf_publish_plan (self, hpp):
+        robot = hpp.robot
+        robot_name = robot.getRobotName()
+        robot_prefix = robot_name + "/"
+        rplen = len(robot_prefix)
+        plan = OrderedDict()
+        universe_child_joint_names = [ jn for jn in robot.getJointNames() if "universe" == robot.getParentJointName(jn) ]
+        rospy.loginfo("Will publish joints {0}".format(universe_child_joint_names))
+        universe_children = set(universe_child_joint_names)
+        # Single pass on the child joints of universe and the robot joints, so
+        # that the links of a joint in both sets are listed once.
+        for jn in robot.getAllJointNames():
+            is_universe_child = jn in universe_children
+            # Publish the robot link as estimated.
+            is_robot_joint = jn.startswith(robot_name)
+            if not is_universe_child and not is_robot_joint: continue
+            for l in robot.getLinkNames(jn):
+                names = plan.setdefault(l, [])
+                if is_universe_child:
+                    if l.startswith(robot_prefix):
+                        names.append(l[rplen:])
+                    else:
+                        names.append(l)
+                if is_robot_joint:
+                    names.append(l)
+        return [ (l, tuple(OrderedDict.fromkeys(names))) for l, names in plan.items() ]
 
+    def _initialize_constraints (self, hpp, q_current):
         hpp.problem.resetConstraints()
 
         if hasattr(self, "manip"): # hpp-manipulation:
@@ -225,7 +299,7 @@ class Estimation(HppClient):
                     state_id = rospy.get_param ("~default_state_id")
                     rospy.logwarn_throttle(1, "At {0}, assumed default current state: {1}".format(self.last_stamp, state_id))
             self.last_state_id = state_id
-            self.publishers["estimation"]["state_id"].publish (state_id)
+            self._publish_state_id (state_id)
 
             # copy constraint from state
             manip.problem.setConstraints (state_id, True)
@@ -234,72 +308,96 @@ class Estimation(HppClient):
             # hpp-corbaserver: setNumericalConstraints
             default_constraints = rospy.get_param ("~default_constraints")
             hpp.problem.addLockedJointConstraints("unused", self.locked_joints)
+            if len(self._default_priorities) != len(default_constraints):
+                self._default_priorities = [ 0, ] * len(default_constraints)
             hpp.problem.addNumericalConstraints ("constraints",
-                    default_constraints,
-                    [ 0 for _ in default_constraints ])
+                    default_constraints, self._default_priorities)
 
         # TODO we should solve the constraints, then add the cost and optimize.
         if len(self.last_visual_tag_constraints) > 0:
             rospy.loginfo_throttle(1, "Adding {0}".format(self.last_visual_tag_constraints))
+            if len(self._visual_tag_priorities) != len(self.last_visual_tag_constraints):
+                self._visual_tag_priorities = [ 1, ] * len(self.last_visual_tag_constraints)
             hpp.problem.addNumericalConstraints ("unused", self.last_visual_tag_constraints,
-                    [ 1 for _ in self.last_visual_tag_constraints ])
+                    self._visual_tag_priorities)
             hpp.problem.setNumericalConstraintsLastPriorityOptional (True)
 
+    ## Get the static information about a joint required by get_joint_state.
+    ## \param jn the joint name, as in the JointState message (i.e. without the robot prefix).
+    ## \return a tuple (HPP joint name, locked joint name, is_rub, lower bound, upper bound).
+    ##         For RUB joints, the bounds are infinite.
+    ## The result is cached as it does not change during a session.
+    def _get_joint_meta (self, robot, jn):
+        meta = self._joint_meta.get(jn)
+        if meta is None:
+            robot_name = robot.getRobotName()
+            name = intern(robot_name + "/" + jn if len(robot_name) > 0 else jn)
+            lock_name = intern('lock_' + name)
+            jt = robot.getJointType(name)
+            if jt.startswith("JointModelRUB"):
+                assert robot.getJointConfigSize(name) == 2, name + " is not of size 2"
+                meta = (name, lock_name, True, -np.inf, np.inf)
+            else:
+                assert robot.getJointConfigSize(name) == 1, name + " is not of size 1"
+                bounds = robot.getJointBounds(name)
+                meta = (name, lock_name, False, bounds[0], bounds[1])
+            self._joint_meta[jn] = meta
+        return meta
+
     def get_joint_state (self, js_msg):
-        from CORBA import UserException
-        self.mutex.acquire()
-        try:
-            hpp = self.hpp()
-            robot_name = hpp.robot.getRobotName()
-            if len(robot_name) > 0: robot_name = robot_name + "/"
-            for jn, q in zip(js_msg.name, js_msg.position):
-                name = robot_name + jn
-                jt = hpp.robot.getJointType(name)
-                if jt.startswith("JointModelRUB"):
-                    assert hpp.robot.getJointConfigSize(name) == 2, name + " is not of size 2"
-                    qjoint = [cos(q), sin(q)]
-                else:
-                    assert hpp.robot.getJointConfigSize(name) == 1, name + " is not of size 1"
-                    # Check joint bounds
-                    bounds = hpp.robot.getJointBounds(name)
-                    if q-bounds[0] < -1e-3 or q-bounds[1] > 1e-3:
-                        rospy.logwarn_throttle(1, "Current state {1} of joint {0} out of bounds {2}"
-                            .format(name, q, bounds))
-                    qjoint = [min(bounds[1],max(bounds[0],q)),]
-                hpp.problem.createLockedJoint ('lock_' + name, name, qjoint)
-            if len(self.locked_joints) == 0:
-                self.locked_joints = tuple(['lock_'+robot_name+n for n in js_msg.name])
-        except UserException as e:
-            rospy.logerr ("Cannot get joint state: {0}".format(e))
-        finally:
-            self.mutex.release()
-
-    def _get_transformation_constraint (self,
+        with self.mutex:
+            try:
+                hpp = self.hpp()
+                robot = hpp.robot
+                n = min(len(js_msg.name), len(js_msg.position))
+                metas = [ self._get_joint_meta (robot, jn) for jn in js_msg.name[:n] ]
+
+                q = np.fromiter(js_msg.position[:n], dtype=np.float64, count=n)
+                lo = np.fromiter((m[3] for m in metas), dtype=np.float64, count=n)
+                hi = np.fromiter((m[4] for m in metas), dtype=np.float64, count=n)
+                cos_q = np.cos(q).tolist()
+                sin_q = np.sin(q).tolist()
+                clipped = np.clip(q, lo, hi).tolist()
+
+                # Check joint bounds
+                for i in np.flatnonzero(np.logical_or(q-lo < -1e-3, q-hi > 1e-3)):
+                    rospy.logwarn_throttle(1, "Current state {1} of joint {0} out of bounds {2}"
+                        .format(metas[i][0], q[i], [lo[i], hi[i]]))
+
+                # hpp-corbaserver cannot update the value of an existing locked
+                # joint so it is created again.
+                createLockedJoint = hpp.problem.createLockedJoint
+                for i, (name, lock_name, is_rub, _, _) in enumerate(metas):
+                    if is_rub:
+                        qjoint = [cos_q[i], sin_q[i]]
+                    else:
+                        qjoint = [clipped[i],]
+                    createLockedJoint (lock_name, name, qjoint)
+                if len(self.locked_joints) == 0:
+                    self.locked_joints = tuple([ m[1] for m in metas ])
+            except UserException as e:
+                rospy.logerr ("Cannot get joint state: {0}".format(e))
+
+    def _get_transformation_constraint (self, hpp,
             joint1, joint2, transform,
             prefix = "", orientationWeight = 1.):
-        hpp = self.hpp()
-
         # Create a relative transformation constraint
         j1 = joint1
         j2 = joint2
 
         name = prefix + j1 + "_" + j2
-        T = [ transform.translation.x,
-              transform.translation.y,
-              transform.translation.z,
-              transform.rotation.x,
-              transform.rotation.y,
-              transform.rotation.z,
-              transform.rotation.w,]
+        tr = transform.translation
+        ro = transform.rotation
+        T = [ tr.x, tr.y, tr.z, ro.x, ro.y, ro.z, ro.w, ]
         if orientationWeight == 1.:
             names = ["T_"+name, ]
             hpp.problem.createTransformationConstraint (names[0], j1, j2, T, [True,]*6)
         else:
-            from hpp import Quaternion
+            oname = "O_"+name
             names = ["P_"+name, "sO_"+name]
             hpp.problem.createPositionConstraint (names[0], j1, j2, T[:3], [0,0,0], [True,]*3)
-            hpp.problem.createOrientationConstraint ("O_"+name, j1, j2, Quaternion(T[3:]).inv().toTuple(), [True,]*3)
-            hpp.problem.scCreateScalarMultiply (names[1], orientationWeight, "O_"+name)
+            hpp.problem.createOrientationConstraint (oname, j1, j2, _quaternionInverse (*T[3:]), [True,]*3)
+            hpp.problem.scCreateScalarMultiply (names[1], orientationWeight, oname)
         return names
 
     def get_visual_tag (self, tsmsg):
@@ -313,16 +411,12 @@ class Estimation(HppClient):
         # - the distance (the farthest, the hardest it is to get the orientation)
         distW = 1.
         # - the above scalar product (the closest to 0, the hardest it is to get the orientation)
-        from hpp import Quaternion
-        from numpy import array
-        oriW = - Quaternion([rot.x, rot.y, rot.z, rot.w,]).transform(array([0,0,1]))[2]
+        oriW = - _rotatedZAxisZ (rot.x, rot.y, rot.z, rot.w)
         # - the tag size (for an orthogonal tag, an error theta in orientation should be considered
         #   equivalent to an position error of theta * tag_size)
         tagsize = 0.063 * 4 # tag size * 4
         s = tagsize * oriW * distW
-        try:
-            self.mutex.acquire()
-
+        with self.mutex:
             j1 = tsmsg.header.frame_id
             j2 = tsmsg.child_frame_id
             if j1.endswith("_measured"): j1 = j1[:-len("_measured")]
@@ -330,7 +424,7 @@ class Estimation(HppClient):
             if "/" not in j1: j1 = self.robot_name + "/" + j1
             if "/" not in j2: j2 = self.robot_name + "/" + j2
 
-            names = self._get_transformation_constraint(j1, j2, tsmsg.transform,
+            names = self._get_transformation_constraint(self.hpp(), j1, j2, tsmsg.transform,
                 prefix="", orientationWeight = s)
             # If this tag is in the next image:
             if self.current_stamp < stamp:
@@ -342,19 +436,16 @@ class Estimation(HppClient):
                 self.current_visual_tag_constraints = list()
                 self.last_stamp_is_ready = True
             self.current_visual_tag_constraints.extend(names)
-        finally:
-            self.mutex.release()
 
     def get_base_pose_estimation (self, ts_msg):
         stamp = ts_msg.header.stamp
         if stamp < self.current_stamp: return
 
-        self.mutex.acquire()
-        try:
+        with self.mutex:
             hpp = self.hpp()
             robot_name = hpp.robot.getRobotName()
 
-            names = self._get_transformation_constraint (
+            names = self._get_transformation_constraint (hpp,
                     "universe", robot_name + "/root_joint", ts_msg.transform,
                     prefix="base/", orientationWeight=1.)
 
@@ -370,5 +461,3 @@ class Estimation(HppClient):
                 self.current_stamp = stamp
                 self.current_visual_tag_constraints = list()
                 self.last_stamp_is_ready = True
-        finally:
-            self.mutex.release()
@@ -44,24 +44,48 @@ def wait_for_service(srv, service_type = None, time=0.2):
     else:
         return None
 
+## Internal function. Walk a hierarchy of dictionaries without recursion.
+## \param namespace prefix for the names of the leaves
+## \param tree a hierarchy of dictionaries
+## \return a pair <tt>(rets, leaves)</tt> where \c rets has the same layout as \c tree
+##         without the leaves, and \c leaves is a list of tuples
+##         <tt>(parent, key, name, value)</tt> such that \c parent is the
+##         dictionary of \c rets which should contain the leaf at \c key,
+##         \c name is the namespace of the leaf and \c value the leaf in \c tree.
+def _flatten (namespace, tree):
+    rets = dict ()
+    leaves = list ()
+    stack = [ (rets, namespace, tree), ]
+    while stack:
+        parent, ns, node = stack.pop()
+        for k, v in node.items():
+            if isinstance(v, dict):
+                parent[k] = dict ()
+                stack.append ((parent[k], ns + "/" + k, v))
+            else:
+                leaves.append ((parent, k, ns + "/" + k, v))
+    return rets, leaves
+
+def _createTopic (object, name, topic, subscribe):
+    if subscribe:
+        try:
+            callback = getattr(object, topic[1])
+        except AttributeError:
+            raise NotImplementedError("Class `{}` does not implement `{}`".format(object.__class__.__name__, topic[1]))
+        return rospy.Subscriber(name, topic[0], callback)
+    else:
+        return rospy.Publisher(name, topic[0], queue_size = topic[1])
+
 ## Internal function. Use createSubscribers or createPublishers instead.
 ## \param subscribe boolean whether this node should subscribe to the topics.
 ##        If False, this node publishes to the topics.
 def _createTopics (object, namespace, topics, subscribe):
-    if isinstance(topics, dict):
-        rets = dict ()
-        for k, v in topics.items():
-            rets[k] = _createTopics(object, namespace + "/" + k, v, subscribe)
-        return rets
-    else:
-        if subscribe:
-            try:
-                callback = getattr(object, topics[1])
-            except AttributeError:
-                raise NotImplementedError("Class `{}` does not implement `{}`".format(object.__class__.__name__, topics[1]))
-            return rospy.Subscriber(namespace, topics[0], callback)
-        else:
-            return rospy.Publisher(namespace, topics[0], queue_size = topics[1])
+    if not isinstance(topics, dict):
+        return _createTopic (object, namespace, topics, subscribe)
+    rets, leaves = _flatten (namespace, topics)
+    for parent, k, name, topic in leaves:
+        parent[k] = _createTopic (object, name, topic, subscribe)
+    return rets
 
 ## Create rospy.Subscriber.
 ## \param object the object containing the callbacks.
@@ -90,24 +114,26 @@ def createSubscribers (object, namespace, topics):
 def createPublishers (namespace, topics):
     return _createTopics (None, namespace, topics, False)
 
+def _createService (object, name, service, serve):
+    if serve:
+        try:
+            callback = getattr(object, service[1])
+        except AttributeError:
+            raise NotImplementedError("Class `{}` does not implement `{}`".format(object.__class__.__name__, service[1]))
+        return rospy.Service(name, service[0], callback)
+    else:
+        return wait_for_service(name, service[0])
+
 def _createServices (object, namespace, services, serve):
     """
     \param serve boolean whether this node should serve or use the topics.
     """
-    if isinstance(services, dict):
-        rets = dict ()
-        for k, v in services.items():
-            rets[k] = _createServices(object, namespace + "/" + k, v, serve)
-        return rets
-    else:
-        if serve:
-            try:
-                callback = getattr(object, services[1])
-            except AttributeError:
-                raise NotImplementedError("Class `{}` does not implement `{}`".format(object.__class__.__name__, services[1]))
-            return rospy.Service(namespace, services[0], callback)
-        else:
-            return wait_for_service(namespace, services[0])
+    if not isinstance(services, dict):
+        return _createService (object, namespace, services, serve)
+    rets, leaves = _flatten (namespace, services)
+    for parent, k, name, service in leaves:
+        parent[k] = _createService (object, name, service, serve)
+    return rets
 
 ## Create rospy.Service.
 ##